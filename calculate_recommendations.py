@@ -1,11 +1,16 @@
 import getopt
+import json
 import logging
+import shutil
 import sys
 from datetime import datetime
+from multiprocessing import Pool
 from pathlib import Path
+from typing import Optional, Tuple
 
 import numpy as np
 import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
 from sklearn.decomposition import TruncatedSVD
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -14,55 +19,159 @@ logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger('voodoo-preprocess')
 logger.setLevel(logging.INFO)
 
-DECKS_CORRELATION_MATRIX_NPY = 'decks_correlation_matrix.npy'
-DECKS_CROSS_TAB_H5 = 'decks_cross_tab.h5'
+CARDS_EXTRACT_JSON = 'cards_extract.json'
 DECKS_PREPROCESSED_CSV = 'decks_preprocessed.csv'
+MODELS_DIR = 'models'
+CARD_IDS_NPY = 'card_ids.npy'
+CORRELATION_MATRIX_NPY = 'correlation_matrix.npy'
+FILTERS_NPY = 'filters.npy'
+FILTER_NAMES_NPY = 'filter_names.npy'
 
+LEGAL_STATUSES = {'Legal', 'Restricted'}
 
-def calculate_recommendations(data_path: Path, force: bool = False):
+ALL_FORMATS = 'all'
+UNKNOWN_FORMAT = 'unknown'
+
+N_COMPONENTS = 250
+POOL_SIZE = 8
+
+decks_matrix: Optional[csr_matrix] = None
+decks_card_ids: Optional[np.ndarray] = None
+decks_card_filters: Optional[np.ndarray] = None
+decks_filter_names: Optional[np.ndarray] = None
+
+
+def init_worker(matrix: csr_matrix, card_ids: np.ndarray, card_filters: np.ndarray, filter_names: np.ndarray):
+    global decks_matrix, decks_card_ids, decks_card_filters, decks_filter_names
+
+    decks_matrix = matrix
+    decks_card_ids = card_ids
+    decks_card_filters = card_filters
+    decks_filter_names = filter_names
+
+
+def build_card_filters(cards_extract_path: Path, card_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    cards = {}
+    with open(cards_extract_path) as f:
+        for line in f:
+            card = json.loads(line)
+            cards[card['voodooId']] = card
+
+    filters = {}
+    for i, card_id in enumerate(card_ids):
+        card = cards.get(card_id, {})
+
+        for format_name, status in (card.get('legalities') or {}).items():
+            if status in LEGAL_STATUSES:
+                filters.setdefault(f'legal:{format_name.lower()}', []).append(i)
+
+        for color in card.get('colors') or []:
+            filters.setdefault(f'color:{color.upper()}', []).append(i)
+
+        for card_type in card.get('types') or []:
+            filters.setdefault(f'type:{card_type.lower()}', []).append(i)
+
+    filter_names = sorted(filters)
+    card_filters = np.zeros((len(filter_names), len(card_ids)), dtype=bool)
+    for row, filter_name in enumerate(filter_names):
+        card_filters[row, filters[filter_name]] = True
+
+    return np.asarray(filter_names, dtype=str), card_filters
+
+
+def calculate_partition(models_path: Path, partition: str, deck_indices: np.ndarray) -> Tuple[str, int, int]:
+    partition_matrix = decks_matrix[deck_indices]
+    card_mask = partition_matrix.getnnz(axis=0) > 0
+    partition_matrix = partition_matrix[:, card_mask]
+    card_ids = decks_card_ids[card_mask]
+
+    n_decks, n_cards = partition_matrix.shape
+    n_components = min(N_COMPONENTS, n_decks - 1, n_cards - 1)
+
+    if n_components < 1:
+        logger.warning(f'partition: {partition} has too few decks or cards, skipping')
+        return partition, 0, 0
+
+    svd = TruncatedSVD(n_components=n_components, random_state=5)
+    partition_results_matrix = svd.fit_transform(partition_matrix.transpose())
+    partition_correlation_matrix = np.corrcoef(partition_results_matrix)
+
+    partition_path = models_path / partition
+    partition_path.mkdir(parents=True)
+    np.save(str(partition_path / CARD_IDS_NPY), card_ids)
+    np.save(str(partition_path / CORRELATION_MATRIX_NPY), partition_correlation_matrix)
+    np.save(str(partition_path / FILTERS_NPY), np.packbits(decks_card_filters[:, card_mask], axis=1))
+    np.save(str(partition_path / FILTER_NAMES_NPY), decks_filter_names)
+
+    return partition, n_decks, n_cards
+
+
+def calculate_recommendations(data_path: Path, force: bool = False, window_days: Optional[int] = None):
     logger.info('calculating recommendations')
 
-    decks_correlation_matrix_path = data_path / DECKS_CORRELATION_MATRIX_NPY
+    cards_extract_path = data_path / CARDS_EXTRACT_JSON
     decks_preprocessed_path = data_path / DECKS_PREPROCESSED_CSV
-    decks_cross_tab_path = data_path / DECKS_CROSS_TAB_H5
+    models_path = data_path / MODELS_DIR
 
     if not decks_preprocessed_path.exists():
         logger.error(f'decks preprocessed file: {decks_preprocessed_path} does not exist, aborting')
         return
 
-    if decks_correlation_matrix_path.exists():
-        logger.warning(f'decks correlation matrix file: {decks_correlation_matrix_path} exists')
-        if force:
-            logger.warning(f'force enabled, removing decks correlation matrix file')
-            decks_correlation_matrix_path.unlink()
-        else:
-            logger.error('force not enabled, aborting')
-            return
+    if not cards_extract_path.exists():
+        logger.error(f'cards extract file: {cards_extract_path} does not exist, aborting')
+        return
 
-    if decks_cross_tab_path.exists():
-        logger.warning(f'decks cross tab file: {decks_cross_tab_path} exists')
+    if models_path.exists():
+        logger.warning(f'models path: {models_path} exists')
         if force:
-            logger.warning(f'force enabled, removing decks cross tab file')
-            decks_cross_tab_path.unlink()
+            logger.warning(f'force enabled, removing models path')
+            shutil.rmtree(models_path)
         else:
             logger.error('force not enabled, aborting')
             return
 
     logger.info('loading deck data')
-    decks_df = pd.read_csv(data_path / DECKS_PREPROCESSED_CSV)
-    decks_cross_tab_df = decks_df.pivot_table(values='Count', index='deckId', columns='voodooId', fill_value=0)
-    logger.info('saving decks cross tab ')
-    decks_cross_tab_df.to_hdf(decks_cross_tab_path, key='decks', mode='w')
+    decks_df = pd.read_csv(decks_preprocessed_path)
+    decks_df = decks_df.dropna(subset=['voodooId'])
+    decks_df['format'] = decks_df['format'].fillna(UNKNOWN_FORMAT)
+
+    if window_days is not None:
+        decks_dates = pd.to_datetime(decks_df['date'], utc=True, errors='coerce')
+        cutoff = decks_dates.max() - pd.Timedelta(days=window_days)
+        decks_df = decks_df[decks_dates >= cutoff]
+        logger.info(f'restricted deck data to {window_days} days from {cutoff.date()}')
+
+    logger.info('building decks matrix')
+    deck_codes, deck_ids = pd.factorize(decks_df['deckId'])
+    card_codes, card_ids = pd.factorize(decks_df['voodooId'])
+    matrix = coo_matrix(
+        (decks_df['Count'].to_numpy(dtype=np.float32), (deck_codes, card_codes)),
+        shape=(len(deck_ids), len(card_ids))).tocsr()
+
+    deck_formats = np.empty(len(deck_ids), dtype=object)
+    deck_formats[deck_codes] = decks_df['format'].to_numpy()
+
+    partitions = {ALL_FORMATS: np.arange(len(deck_ids))}
+    for format_name in np.unique(deck_formats):
+        if format_name != UNKNOWN_FORMAT:
+            partitions[format_name] = np.flatnonzero(deck_formats == format_name)
+
+    logger.info(f'calculating models for {len(partitions)} partitions: {", ".join(partitions)}')
+    models_path.mkdir(parents=True)
+
+    # largest partitions first so the pool is not left waiting on one big model at the end
+    tasks = [(models_path, partition, deck_indices) for partition, deck_indices in
+             sorted(partitions.items(), key=lambda item: len(item[1]), reverse=True)]
 
-    svd = TruncatedSVD(n_components=250, random_state=5)
+    card_ids = np.asarray(card_ids, dtype=str)
 
-    logger.info('calculating deck results matrix')
-    decks_results_matrix = svd.fit_transform(decks_cross_tab_df.transpose())
+    logger.info('building card filters')
+    filter_names, card_filters = build_card_filters(cards_extract_path, card_ids)
 
-    logger.info('calculating deck correlation matrix')
-    decks_correlation_matrix = np.corrcoef(decks_results_matrix)
-    logger.info('saving deck correlation matrix')
-    np.save(str(data_path / DECKS_CORRELATION_MATRIX_NPY), decks_correlation_matrix)
+    initargs = (matrix, card_ids, card_filters, filter_names)
+    with Pool(min(POOL_SIZE, len(tasks)), initializer=init_worker, initargs=initargs) as pool:
+        for partition, n_decks, n_cards in pool.starmap(calculate_partition, tasks):
+            logger.info(f'partition: {partition} completed, {n_decks} decks, {n_cards} cards')
 
     logger.info('calculating recommendations completed')
 
@@ -72,6 +181,7 @@ def usage():
     print('  -h: help')
     print('  -d: data path')
     print('  -f: force')
+    print('  -w: date window in days')
 
     sys.exit(0)
 
@@ -80,13 +190,14 @@ def main():
     start = datetime.now()
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hfd:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hfd:w:')
     except getopt.GetoptError as error:
         print(error)
         sys.exit(-1)
 
     data_path = None
     force = False
+    window_days = None
 
     for o, a in opts:
         if o == '-h':
@@ -95,6 +206,8 @@ def main():
             data_path = Path(a)
         elif o == '-f':
             force = True
+        elif o == '-w':
+            window_days = int(a)
         else:
             assert False, 'unhandled option'
 
@@ -108,7 +221,7 @@ def main():
 
     logger.info('voodoo calculate recommendations launching')
 
-    calculate_recommendations(data_path, force)
+    calculate_recommendations(data_path, force, window_days)
 
     elapsed = datetime.now() - start
     hours = elapsed.seconds // 3600
@@ -26,6 +26,7 @@ BATCH_SIZE = 1000
 VOODOO_MONGO_DB = 'voodoo'
 VOODOO_MONGO_COLLECTION_CARDS = 'cards'
 VOODOO_MONGO_COLLECTION_DECKS = 'decks'
+VOODOO_MONGO_COLLECTION_METADATA = 'metadata'
 VOODOO_MONGO_COLLECTION_SETS = 'sets'
 VOODOO_MONGO_COLLECTION_TOURNAMENTS = 'tournaments'
 
@@ -33,6 +34,9 @@ MTGJSON_ATOMIC_CARDS_FILE = 'mtg_json/AtomicCards.json'
 MTGJSON_SET_LIST_FILE = 'mtg_json/SetList.json'
 MTGO_DECKLIST_CACHE_PATH = 'mtgo_decklist_cache/Tournaments'
 
+FORMATS = ['standard', 'pioneer', 'modern', 'legacy', 'vintage', 'pauper', 'historic', 'explorer', 'alchemy']
+UNKNOWN_FORMAT = 'unknown'
+
 
 def convert_decimal(dict_item: object) -> object:
     if dict_item is None:
@@ -53,6 +57,16 @@ def convert_decimal(dict_item: object) -> object:
     return dict_item
 
 
+def get_format(tournament_name: str) -> str:
+    words = tournament_name.lower().split()
+
+    for format_name in FORMATS:
+        if format_name in words:
+            return format_name
+
+    return UNKNOWN_FORMAT
+
+
 def get_database(hostname: str, port: str, username: str, password: str) -> Database:
     connection_string = f'mongodb://{username}:{password}@{hostname}:{port}'
     client = MongoClient(connection_string)
@@ -97,6 +111,11 @@ def process_cards(db: Database, path: Path):
 
         collection.bulk_write(operations)
 
+    db[VOODOO_MONGO_COLLECTION_METADATA].update_one(
+        {'name': VOODOO_MONGO_COLLECTION_CARDS},
+        {'$set': {'version': str(uuid.uuid4()), 'updated': datetime.utcnow()}},
+        upsert=True)
+
     logger.info(f'processing cards completed, {len(cards_data_list)} cards processed')
 
 
@@ -147,6 +166,11 @@ def process_tournaments(db: Database, path: Path):
                  'Tournament.Date': data['Tournament']['Date']},
                 {'$set': convert_decimal(data), '$setOnInsert': {'voodooId': str(uuid.uuid4())}},
                 upsert=True))
+
+            format_name = get_format(data['Tournament']['Name'])
+            for deck in data['Decks']:
+                deck['Format'] = format_name
+
             decks = decks + data['Decks']
 
         process_decks(db, decks)
@@ -1,16 +1,55 @@
 #!/bin/bash
 
-DATA_DIR=./data
+DATA_DIR=${DATA_DIR:-./data}
 MTGJSON_DATA_DIR=${DATA_DIR}/mtg_json
 MTGO_DECKLIST_CACHE_DIR=${DATA_DIR}/mtgo_decklist_cache
 ATOMIC_CARDS_JSON_URL=https://mtgjson.com/api/v5/AtomicCards.json
 SET_LIST_JSON_URL=https://mtgjson.com/api/v5/SetList.json
 MTGO_DECKLIST_CACHE_GIT_URI=https://github.com/Badaro/MTGODecklistCache.git
 
+# downloads go to a temporary directory first so a failed download never removes the current data
+download_mtgjson() {
+  local download_dir
+  download_dir=$(mktemp -d ${DATA_DIR}/.mtg_json.XXXXXX) || return 1
+
+  if wget -P ${download_dir} ${ATOMIC_CARDS_JSON_URL} && wget -P ${download_dir} ${SET_LIST_JSON_URL}; then
+    mkdir -p ${MTGJSON_DATA_DIR}
+    mv -f ${download_dir}/*.json ${MTGJSON_DATA_DIR}/
+    rm -rf ${download_dir}
+  else
+    rm -rf ${download_dir}
+    return 1
+  fi
+}
+
+download_decklists() {
+  if [ -d ${MTGO_DECKLIST_CACHE_DIR}/.git ]; then
+    git -C ${MTGO_DECKLIST_CACHE_DIR} fetch && git -C ${MTGO_DECKLIST_CACHE_DIR} reset --hard origin/HEAD
+    return
+  fi
+
+  local download_dir
+  download_dir=$(mktemp -d ${DATA_DIR}/.mtgo_decklist_cache.XXXXXX) || return 1
+
+  if git clone ${MTGO_DECKLIST_CACHE_GIT_URI} ${download_dir}; then
+    rm -rf ${MTGO_DECKLIST_CACHE_DIR}
+    mv ${download_dir} ${MTGO_DECKLIST_CACHE_DIR}
+  else
+    rm -rf ${download_dir}
+    return 1
+  fi
+}
+
 mkdir -p ${DATA_DIR}
-rm -f ${MTGJSON_DATA_DIR}/*.json
-rm -rf ${MTGO_DECKLIST_CACHE_DIR}
 
-wget -P ${MTGJSON_DATA_DIR} ${ATOMIC_CARDS_JSON_URL}
-wget -P ${MTGJSON_DATA_DIR} ${SET_LIST_JSON_URL}
-git clone ${MTGO_DECKLIST_CACHE_GIT_URI} ${MTGO_DECKLIST_CACHE_DIR}
+case "$1" in
+  mtgjson)
+    download_mtgjson
+    ;;
+  decklists)
+    download_decklists
+    ;;
+  *)
+    download_mtgjson && download_decklists
+    ;;
+esac
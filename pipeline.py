@@ -0,0 +1,443 @@
+import getopt
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+from http.client import HTTPException
+from urllib.request import Request, urlopen
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger('voodoo-pipeline')
+logger.setLevel(logging.INFO)
+
+SCRIPTS_PATH = Path(__file__).resolve().parent
+
+PIPELINE_STATE_JSON = '.pipeline_state.json'
+VOODOO_DATA_DIR = 'voodoo'
+
+ATOMIC_CARDS_JSON_URL = 'https://mtgjson.com/api/v5/AtomicCards.json'
+SET_LIST_JSON_URL = 'https://mtgjson.com/api/v5/SetList.json'
+MTGO_DECKLIST_CACHE_GIT_URI = 'https://github.com/Badaro/MTGODecklistCache.git'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+REMOTE_VERSION_TIMEOUT = 30
+POOL_SIZE = 4
+
+
+class Stage(NamedTuple):
+    name: str
+    sources: List[str]
+    command: List[str]
+    depends: List[str]
+    inputs: List[str]
+    outputs: List[str]
+    params: Callable[[], Optional[dict]]
+
+
+class FileHasher:
+    def __init__(self, cache: dict):
+        self.cache = cache
+        self.touched = set()
+        self.lock = threading.Lock()
+
+    def hash_file(self, path: Path) -> str:
+        stat = path.stat()
+        key = str(path)
+
+        with self.lock:
+            self.touched.add(key)
+            cached = self.cache.get(key)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        with self.lock:
+            self.cache[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+        return digest.hexdigest()
+
+    def hash_path(self, path: Path) -> Optional[str]:
+        if path.is_file():
+            return self.hash_file(path)
+
+        if not path.is_dir():
+            return None
+
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != '.git')
+            for filename in sorted(files):
+                file_path = Path(root) / filename
+                digest.update(f'{file_path.relative_to(path)}:{self.hash_file(file_path)}\n'.encode())
+
+        return digest.hexdigest()
+
+    def hash_paths(self, data_path: Path, paths: List[str]) -> Optional[Dict[str, str]]:
+        digests = {}
+        for path in paths:
+            digest = self.hash_path(data_path / path)
+            if digest is None:
+                return None
+            digests[path] = digest
+
+        return digests
+
+    def prune(self):
+        with self.lock:
+            for key in set(self.cache) - self.touched:
+                del self.cache[key]
+
+
+def get_url_version(url: str) -> Optional[str]:
+    try:
+        with urlopen(Request(url, method='HEAD'), timeout=REMOTE_VERSION_TIMEOUT) as response:
+            return response.headers.get('ETag') or response.headers.get('Last-Modified')
+    except (OSError, HTTPException) as error:
+        logger.warning(f'unable to check {url}: {error}')
+        return None
+
+
+def get_git_version(uri: str) -> Optional[str]:
+    try:
+        result = subprocess.run(['git', 'ls-remote', uri, 'HEAD'], capture_output=True, text=True,
+                                timeout=REMOTE_VERSION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        logger.warning(f'unable to check {uri}: timed out after {REMOTE_VERSION_TIMEOUT}s')
+        return None
+    except OSError as error:
+        logger.warning(f'unable to check {uri}: {error}')
+        return None
+
+    if result.returncode != 0 or not result.stdout:
+        logger.warning(f'unable to check {uri}: {result.stderr.strip()}')
+        return None
+
+    return result.stdout.split()[0]
+
+
+def get_stages(data_path: Path, mongo_hostname: str, mongo_port: str, mongo_username: str, mongo_password: str,
+               redis_hostname: str, redis_port: int, redis_password: Optional[str],
+               window_days: Optional[int]) -> List[Stage]:
+    voodoo_data_path = data_path / VOODOO_DATA_DIR
+
+    def remote_versions(*versions: Callable[[], Optional[str]]) -> Callable[[], Optional[dict]]:
+        def params() -> Optional[dict]:
+            results = [version() for version in versions]
+            return None if None in results else {'versions': results}
+
+        return params
+
+    calculate_command = [sys.executable, str(SCRIPTS_PATH / 'calculate_recommendations.py'),
+                         '-d', str(voodoo_data_path), '-f']
+    if window_days is not None:
+        calculate_command += ['-w', str(window_days)]
+
+    populate_redis_command = [sys.executable, str(SCRIPTS_PATH / 'populate_redis.py'),
+                              '-d', str(voodoo_data_path), '-n', redis_hostname, '-r', str(redis_port)]
+    if redis_password is not None:
+        populate_redis_command += ['-p', redis_password]
+
+    return [
+        Stage(
+            name='download_mtgjson',
+            sources=['download.sh'],
+            command=['bash', str(SCRIPTS_PATH / 'download.sh'), 'mtgjson'],
+            depends=[],
+            inputs=[],
+            outputs=['mtg_json/AtomicCards.json', 'mtg_json/SetList.json'],
+            params=remote_versions(lambda: get_url_version(ATOMIC_CARDS_JSON_URL),
+                                   lambda: get_url_version(SET_LIST_JSON_URL))),
+        Stage(
+            name='download_decklists',
+            sources=['download.sh'],
+            command=['bash', str(SCRIPTS_PATH / 'download.sh'), 'decklists'],
+            depends=[],
+            inputs=[],
+            outputs=['mtgo_decklist_cache/Tournaments'],
+            params=remote_versions(lambda: get_git_version(MTGO_DECKLIST_CACHE_GIT_URI))),
+        Stage(
+            name='dataload',
+            sources=['dataload.py'],
+            command=[sys.executable, str(SCRIPTS_PATH / 'dataload.py'), '-d', str(data_path),
+                     '-n', mongo_hostname, '-r', mongo_port, '-u', mongo_username, '-p', mongo_password],
+            depends=['download_mtgjson', 'download_decklists'],
+            inputs=['mtg_json/AtomicCards.json', 'mtg_json/SetList.json', 'mtgo_decklist_cache/Tournaments'],
+            outputs=[],
+            params=lambda: {'hostname': mongo_hostname, 'port': mongo_port}),
+        Stage(
+            name='extract',
+            sources=['extract.sh'],
+            command=['bash', str(SCRIPTS_PATH / 'extract.sh'), mongo_hostname, mongo_username, mongo_password,
+                     mongo_port],
+            depends=['dataload'],
+            inputs=[],
+            outputs=['voodoo/cards_extract.csv', 'voodoo/cards_extract.json', 'voodoo/decks_extract.json'],
+            params=lambda: {'hostname': mongo_hostname, 'port': mongo_port}),
+        Stage(
+            name='preprocess',
+            sources=['preprocess.py'],
+            command=[sys.executable, str(SCRIPTS_PATH / 'preprocess.py'), '-d', str(voodoo_data_path)],
+            depends=['extract'],
+            inputs=['voodoo/cards_extract.csv', 'voodoo/decks_extract.json'],
+            outputs=['voodoo/decks_preprocessed.csv'],
+            params=lambda: {}),
+        Stage(
+            name='calculate_recommendations',
+            sources=['calculate_recommendations.py'],
+            command=calculate_command,
+            depends=['preprocess'],
+            inputs=['voodoo/decks_preprocessed.csv', 'voodoo/cards_extract.json'],
+            outputs=['voodoo/models'],
+            params=lambda: {'window_days': window_days}),
+        Stage(
+            name='populate_redis',
+            sources=['populate_redis.py', 'redis_keys.py'],
+            command=populate_redis_command,
+            depends=['calculate_recommendations'],
+            inputs=['voodoo/models'],
+            outputs=[],
+            params=lambda: {'hostname': redis_hostname, 'port': redis_port}),
+    ]
+
+
+def get_fingerprint(stage: Stage, params: Optional[dict], data_path: Path, hasher: FileHasher,
+                    stages_state: dict) -> Optional[str]:
+    if params is None:
+        return None
+
+    inputs = hasher.hash_paths(data_path, stage.inputs)
+    if inputs is None:
+        return None
+
+    # stages without file outputs (e.g. loading mongo) are tracked through their own fingerprint
+    upstream = {name: stages_state[name]['fingerprint'] for name in stage.depends
+                if not stages_state.get(name, {}).get('outputs')}
+
+    sources = {source: hasher.hash_file(SCRIPTS_PATH / source) for source in stage.sources}
+    fingerprint = {'sources': sources, 'params': params, 'inputs': inputs, 'upstream': upstream}
+
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def run_stage(stage: Stage, data_path: Path, hasher: FileHasher, stages_state: dict, force: bool) -> Optional[dict]:
+    params = stage.params()
+    fingerprint = get_fingerprint(stage, params, data_path, hasher, stages_state)
+    last_run = stages_state.get(stage.name)
+
+    if not force and last_run is not None and hasher.hash_paths(data_path, stage.outputs) == last_run['outputs']:
+        if fingerprint is not None and fingerprint == last_run['fingerprint']:
+            logger.info(f'stage: {stage.name} unchanged, skipping')
+            return None
+
+        # e.g. offline: keep the last good outputs rather than rerunning a download that can only fail
+        if params is None:
+            logger.warning(f'stage: {stage.name} parameters unavailable, keeping outputs of the last run')
+            return None
+
+    logger.info(f'stage: {stage.name} running')
+    start = datetime.now()
+
+    env = dict(os.environ, DATA_DIR=str(data_path))
+    result = subprocess.run(stage.command, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f'exited with status {result.returncode}')
+
+    outputs = hasher.hash_paths(data_path, stage.outputs)
+    if outputs is None:
+        raise RuntimeError('outputs not produced')
+
+    if fingerprint is None:
+        fingerprint = get_fingerprint(stage, stage.params(), data_path, hasher, stages_state)
+
+    logger.info(f'stage: {stage.name} completed in {(datetime.now() - start).seconds}s')
+
+    return {'fingerprint': fingerprint, 'outputs': outputs, 'completed': datetime.now().isoformat()}
+
+
+def load_state(state_path: Path) -> dict:
+    if not state_path.exists():
+        return {'files': {}, 'stages': {}}
+
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(state_path: Path, state: dict, hasher: FileHasher):
+    temporary_path = state_path.with_suffix('.tmp')
+    with hasher.lock, open(temporary_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    temporary_path.replace(state_path)
+
+
+def run_pipeline(data_path: Path, stages: List[Stage], force: bool = False) -> bool:
+    logger.info('running pipeline')
+
+    state_path = data_path / PIPELINE_STATE_JSON
+    state = load_state(state_path)
+    hasher = FileHasher(state['files'])
+    stages_state = state['stages']
+
+    pending = {stage.name: stage for stage in stages}
+    completed = set()
+    failed = set()
+    running: Dict[Future, Stage] = {}
+
+    with ThreadPoolExecutor(POOL_SIZE) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(depend in failed for depend in stage.depends):
+                    logger.error(f'stage: {name} skipped, upstream stage failed')
+                    failed.add(name)
+                    del pending[name]
+                elif all(depend in completed for depend in stage.depends):
+                    running[executor.submit(run_stage, stage, data_path, hasher, stages_state, force)] = stage
+                    del pending[name]
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    logger.error(f'stage: {stage.name} failed: {error}')
+                    failed.add(stage.name)
+                    continue
+
+                if result is not None:
+                    stages_state[stage.name] = result
+                    save_state(state_path, state, hasher)
+                completed.add(stage.name)
+
+    failed.update(pending)
+
+    if not failed:
+        hasher.prune()
+
+    save_state(state_path, state, hasher)
+
+    if failed:
+        logger.error(f'pipeline failed, stages not completed: {", ".join(sorted(failed))}')
+        return False
+
+    logger.info('running pipeline completed')
+    return True
+
+
+def usage():
+    print('usage: pipeline.py [-dfhnruptsaw]')
+    print('  -h: help')
+    print('  -d: data path')
+    print('  -f: force, run every stage')
+    print('  -n: mongo hostname')
+    print('  -r: mongo port')
+    print('  -u: mongo username')
+    print('  -p: mongo password')
+    print('  -s: redis hostname')
+    print('  -t: redis port')
+    print('  -a: redis password')
+    print('  -w: date window in days')
+
+    sys.exit(0)
+
+
+def main():
+    start = datetime.now()
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hfd:n:r:u:p:s:t:a:w:')
+    except getopt.GetoptError as error:
+        print(error)
+        sys.exit(-1)
+
+    data_path = None
+    force = False
+    mongo_hostname = None
+    mongo_port = '27017'
+    mongo_username = None
+    mongo_password = None
+    redis_hostname = None
+    redis_port = 6379
+    redis_password = None
+    window_days = None
+
+    for o, a in opts:
+        if o == '-h':
+            usage()
+        elif o == '-d':
+            data_path = Path(a).resolve()
+        elif o == '-f':
+            force = True
+        elif o == '-n':
+            mongo_hostname = a
+        elif o == '-r':
+            mongo_port = a
+        elif o == '-u':
+            mongo_username = a
+        elif o == '-p':
+            mongo_password = a
+        elif o == '-s':
+            redis_hostname = a
+        elif o == '-t':
+            redis_port = int(a)
+        elif o == '-a':
+            redis_password = a
+        elif o == '-w':
+            window_days = int(a)
+        else:
+            assert False, 'unhandled option'
+
+    if data_path is None:
+        print('must specify data path')
+        sys.exit(-1)
+
+    if mongo_hostname is None:
+        print('must specify mongo hostname')
+        sys.exit(-1)
+
+    if mongo_username is None:
+        print('must specify mongo username')
+        sys.exit(-1)
+
+    if mongo_password is None:
+        print('must specify mongo password')
+        sys.exit(-1)
+
+    if redis_hostname is None:
+        print('must specify redis hostname')
+        sys.exit(-1)
+
+    logger.info('voodoo pipeline launching')
+
+    data_path.mkdir(parents=True, exist_ok=True)
+    stages = get_stages(data_path, mongo_hostname, mongo_port, mongo_username, mongo_password,
+                        redis_hostname, redis_port, redis_password, window_days)
+    success = run_pipeline(data_path, stages, force)
+
+    elapsed = datetime.now() - start
+    hours = elapsed.seconds // 3600
+    minutes = elapsed.seconds // 60 % 60
+    seconds = elapsed.seconds % 60
+    logger.info(f'voodoo pipeline completed in {hours}h {minutes}m {seconds}s')
+
+    if not success:
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
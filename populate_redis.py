@@ -2,47 +2,116 @@ import getopt
 import logging
 import pickle
 import sys
+import uuid
 from datetime import datetime
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 
 from redis import Redis
 
+from redis_keys import (REDIS_CARD_IDS_KEY, REDIS_FILTERS_KEY, REDIS_PREVIOUS_VERSION_KEY, REDIS_VERSION_KEY,
+                        get_format_key, get_formats_key, get_version, get_version_prefix)
+
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger('voodoo-dataload')
 logger.setLevel(logging.INFO)
 
-DECKS_CORRELATION_MATRIX_NPY = 'decks_correlation_matrix.npy'
-DECKS_CROSS_TAB_H5 = 'decks_cross_tab.h5'
+MODELS_DIR = 'models'
+CARD_IDS_NPY = 'card_ids.npy'
+CORRELATION_MATRIX_NPY = 'correlation_matrix.npy'
+FILTERS_NPY = 'filters.npy'
+FILTER_NAMES_NPY = 'filter_names.npy'
+
+DELETE_BATCH_SIZE = 1000
+
+# the single-model layout stored each card's recommendations under its bare voodooId
+LEGACY_CARD_KEY_PATTERN = '????????-????-????-????-????????????'
 
 
 def get_redis_client(hostname: str, port: int, password: str) -> Redis:
     return Redis(host=hostname, port=port, password=password)
 
 
-def populate_redis(data_path: Path, redis_client: Redis):
-    logger.info('loading decks cross tab')
-    decks_cross_tab_df = pd.read_hdf(data_path / DECKS_CROSS_TAB_H5, 'decks')
+def populate_format(partition_path: Path, redis_client: Redis, version: str):
+    format_name = partition_path.name
+
+    logger.info(f'loading {format_name} correlation matrix')
+    card_ids = np.load(str(partition_path / CARD_IDS_NPY))
+    correlation_matrix = np.load(str(partition_path / CORRELATION_MATRIX_NPY)).astype(np.float32)
+
+    logger.info(f'populating redis for {format_name}')
+
+    redis_client.set(get_format_key(version, format_name, REDIS_CARD_IDS_KEY), pickle.dumps(card_ids))
+
+    for card_id, correlations in zip(card_ids, correlation_matrix):
+        redis_client.set(get_format_key(version, format_name, card_id), correlations.tobytes())
+
+    filters = {
+        'names': np.load(str(partition_path / FILTER_NAMES_NPY)).tolist(),
+        'bits': np.load(str(partition_path / FILTERS_NPY))}
+    redis_client.set(get_format_key(version, format_name, REDIS_FILTERS_KEY), pickle.dumps(filters))
+
+    logger.info(f'populating redis for {format_name} completed, {len(card_ids)} cards processed')
+
+
+def populate_redis(data_path: Path, redis_client: Redis) -> bool:
+    models_path = data_path / MODELS_DIR
+
+    if not models_path.exists():
+        logger.error(f'models path: {models_path} does not exist, aborting')
+        return False
 
-    logger.info('loading decks correlation matrix')
-    decks_correlation_matrix_df = pd.DataFrame(np.load(str(data_path / DECKS_CORRELATION_MATRIX_NPY)))
-    decks_correlation_matrix_df = decks_correlation_matrix_df.set_index(decks_cross_tab_df.columns)
-    decks_correlation_matrix_df.columns = list(decks_cross_tab_df.columns)
+    partition_paths = sorted(p for p in models_path.iterdir() if (p / CORRELATION_MATRIX_NPY).exists())
 
-    logger.info('populating redis')
+    if len(partition_paths) == 0:
+        logger.error(f'models path: {models_path} contains no models, aborting')
+        return False
 
-    for i in range(len(decks_correlation_matrix_df.index)):
-        recommendations = pd.DataFrame({
-            'correlation': decks_correlation_matrix_df.iloc[i],
-            'voodooId': decks_correlation_matrix_df.index})
+    version = uuid.uuid4().hex
+    logger.info(f'populating redis version {version}')
 
-        redis_client.set(decks_correlation_matrix_df.iloc[i].name, pickle.dumps(recommendations))
+    for partition_path in partition_paths:
+        populate_format(partition_path, redis_client, version)
 
-    logger.info(f'populating redis completed, {len(decks_correlation_matrix_df.index)} cards processed')
+    redis_client.sadd(get_formats_key(version), *[p.name for p in partition_paths])
+
+    # readers resolve the version once per request, so the replaced version is kept until the next run
+    previous_version = get_version(redis_client)
+    dropped_version = get_version(redis_client, REDIS_PREVIOUS_VERSION_KEY)
+    pipeline = redis_client.pipeline()
+    if previous_version is not None:
+        pipeline.set(REDIS_PREVIOUS_VERSION_KEY, previous_version)
+    pipeline.set(REDIS_VERSION_KEY, version)
+    pipeline.execute()
+
+    if dropped_version is not None:
+        delete_keys(redis_client, f'{get_version_prefix(dropped_version)}*')
+
+    delete_keys(redis_client, LEGACY_CARD_KEY_PATTERN)
+
+    logger.info(f'populating redis completed, {len(partition_paths)} formats processed')
+
+    return True
+
+
+def delete_keys(redis_client: Redis, pattern: str):
+    logger.info(f'deleting keys matching {pattern}')
+
+    keys = []
+    deleted = 0
+    for key in redis_client.scan_iter(match=pattern, count=DELETE_BATCH_SIZE):
+        keys.append(key)
+        if len(keys) >= DELETE_BATCH_SIZE:
+            deleted += redis_client.delete(*keys)
+            keys = []
+
+    if len(keys) > 0:
+        deleted += redis_client.delete(*keys)
+
+    logger.info(f'deleting keys matching {pattern} completed, {deleted} keys deleted')
 
 
 def usage():
@@ -99,7 +168,7 @@ def main():
     logger.info('voodoo populate redis launching')
 
     redis_client = get_redis_client(hostname, port, password)
-    populate_redis(data_path, redis_client)
+    success = populate_redis(data_path, redis_client)
 
     elapsed = datetime.now() - start
     hours = elapsed.seconds // 3600
@@ -107,6 +176,9 @@ def main():
     seconds = elapsed.seconds % 60
     logger.info(f'voodoo populate redis completed in {hours}h {minutes}m {seconds}s')
 
+    if not success:
+        sys.exit(-1)
+
 
 if __name__ == '__main__':
     main()
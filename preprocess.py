@@ -21,6 +21,8 @@ CARDS_EXTRACT_CSV = 'cards_extract.csv'
 DECKS_EXTRACT_JSON = 'decks_extract.json'
 DECKS_PREPROCESSED_CSV = 'decks_preprocessed.csv'
 
+UNKNOWN_FORMAT = 'unknown'
+
 BATCH_SIZE = 10000
 POOL_SIZE = 8
 
@@ -38,7 +40,9 @@ def preprocess_deck(deck: dict, cards_df: DataFrame) -> DataFrame:
     deck_df = pd.merge(deck_df, cards_df, how='left', on='CardName')
     deck_df = deck_df.drop(['CardName'], axis=1)
     deck_df['deckId'] = deck['voodooId']
-    deck_df = deck_df[['deckId', 'voodooId', 'Count']]
+    deck_df['format'] = deck.get('Format', UNKNOWN_FORMAT)
+    deck_df['date'] = deck.get('Date')
+    deck_df = deck_df[['deckId', 'voodooId', 'Count', 'format', 'date']]
     deck_df = deck_df.set_index('deckId')
 
     return deck_df
@@ -52,7 +56,7 @@ def preprocess(data_path: Path):
     cards_df.rename(columns={'name': 'CardName'}, inplace=True)
     cards_df['CardName'] = cards_df['CardName'].str.lower()
 
-    headers = pd.DataFrame({'deckId': [], 'voodooId': [], 'Count': []})
+    headers = pd.DataFrame({'deckId': [], 'voodooId': [], 'Count': [], 'format': [], 'date': []})
     headers.to_csv(data_path / DECKS_PREPROCESSED_CSV, index=False)
 
     logger.info('loading decks')
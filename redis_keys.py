@@ -0,0 +1,28 @@
+from typing import Optional
+
+from redis import Redis
+
+REDIS_NAMESPACE = 'voodoo'
+REDIS_VERSION_KEY = f'{REDIS_NAMESPACE}:version'
+REDIS_PREVIOUS_VERSION_KEY = f'{REDIS_NAMESPACE}:previous_version'
+REDIS_FORMATS_KEY = 'formats'
+REDIS_CARD_IDS_KEY = 'card_ids'
+REDIS_FILTERS_KEY = 'filters'
+
+
+def get_version(redis_client: Redis, key: str = REDIS_VERSION_KEY) -> Optional[str]:
+    version = redis_client.get(key)
+
+    return None if version is None else version.decode()
+
+
+def get_version_prefix(version: str) -> str:
+    return f'{REDIS_NAMESPACE}:{version}:'
+
+
+def get_formats_key(version: str) -> str:
+    return f'{get_version_prefix(version)}{REDIS_FORMATS_KEY}'
+
+
+def get_format_key(version: str, format_name: str, key: str) -> str:
+    return f'{get_version_prefix(version)}{format_name}:{key}'
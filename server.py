@@ -1,8 +1,13 @@
+import asyncio
 import logging
 import pickle
 import sys
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-import pandas as pd
+import numpy as np
 
 from bson import json_util
 from pymongo import MongoClient
@@ -12,14 +17,25 @@ from redis import Redis
 from tornado import ioloop
 from tornado import web
 
+from redis_keys import REDIS_CARD_IDS_KEY, REDIS_FILTERS_KEY, get_format_key, get_formats_key, get_version
+
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger('voodoo-dataload')
 logger.setLevel(logging.INFO)
 
+DEFAULT_FORMAT = 'all'
 DEFAULT_NUMBER_OF_RECOMMENDATIONS = 20
+COLORS = ['W', 'U', 'B', 'R', 'G']
 VOODOO_MONGO_DB = 'voodoo'
+VOODOO_MONGO_COLLECTION_CARDS = 'cards'
+VOODOO_MONGO_COLLECTION_METADATA = 'metadata'
+
+CARD_INDEX_REFRESH_INTERVAL = 60
+DEFAULT_NUMBER_OF_SEARCH_RESULTS = 10
+MAX_NUMBER_OF_SEARCH_RESULTS = 100
+MIN_FUZZY_SEARCH_SCORE = 0.5
 
 
 def get_database(hostname: str, port: str, username: str, password: str) -> Database:
@@ -39,22 +55,224 @@ def get_redis_client(hostname: str, port: int, password: str) -> Redis:
     return Redis(host=hostname, port=port, password=password)
 
 
+def normalize_name(name: str) -> str:
+    name = unicodedata.normalize('NFKD', name)
+    return ''.join(c for c in name if not unicodedata.combining(c)).lower().strip()
+
+
+def get_trigrams(name: str) -> set:
+    padded_name = f'  {name} '
+    return {padded_name[i:i + 3] for i in range(len(padded_name) - 2)}
+
+
+class CardIndex:
+    def __init__(self, cards: Iterable[dict], version: Optional[str] = None):
+        self.version = version
+        self.cards: Dict[str, str] = {}
+
+        entries = []
+        for card in cards:
+            self.cards[card['voodooId']] = json_util.dumps(card)
+            entries.append((normalize_name(card['name']), card['name'], card['voodooId']))
+
+        entries.sort()
+        self.normalized_names = [entry[0] for entry in entries]
+        self.names = [entry[1] for entry in entries]
+        self.card_ids = [entry[2] for entry in entries]
+
+        trigrams = defaultdict(list)
+        self.trigram_counts = np.zeros(len(entries), dtype=np.int32)
+        for i, normalized_name in enumerate(self.normalized_names):
+            name_trigrams = get_trigrams(normalized_name)
+            self.trigram_counts[i] = len(name_trigrams)
+            for trigram in name_trigrams:
+                trigrams[trigram].append(i)
+
+        self.trigrams = {trigram: np.array(indices, dtype=np.int32) for trigram, indices in trigrams.items()}
+        self.name_index = dict(zip(self.card_ids, self.names))
+
+    def __len__(self) -> int:
+        return len(self.card_ids)
+
+    def get_card(self, card_id: str) -> Optional[str]:
+        return self.cards.get(card_id)
+
+    def get_name(self, card_id: str) -> Optional[str]:
+        return self.name_index.get(card_id)
+
+    def prefix_search(self, prefix: str, limit: int) -> List[int]:
+        results = []
+        i = bisect_left(self.normalized_names, prefix)
+        while i < len(self.normalized_names) and len(results) < limit:
+            if not self.normalized_names[i].startswith(prefix):
+                break
+            results.append(i)
+            i += 1
+
+        return results
+
+    def fuzzy_search(self, query: str, limit: int) -> List[int]:
+        query_trigrams = get_trigrams(query)
+        postings = [self.trigrams[trigram] for trigram in query_trigrams if trigram in self.trigrams]
+        if len(postings) == 0:
+            return []
+
+        # score by how much of the query is covered so short queries still match a word inside a longer name
+        hits = np.bincount(np.concatenate(postings), minlength=len(self.card_ids))
+        scores = hits / len(query_trigrams)
+        candidates = np.flatnonzero(scores >= MIN_FUZZY_SEARCH_SCORE)
+
+        # equal coverage ranks the shorter, closer name first
+        order = np.lexsort((self.trigram_counts[candidates], -scores[candidates]))
+
+        return [int(i) for i in candidates[order[:limit]]]
+
+    def search(self, query: str, limit: int = DEFAULT_NUMBER_OF_SEARCH_RESULTS) -> List[dict]:
+        query = normalize_name(query)
+        if len(query) == 0:
+            return []
+
+        results = self.prefix_search(query, limit)
+        if len(results) < limit:
+            results += [i for i in self.fuzzy_search(query, limit) if i not in results][:limit - len(results)]
+
+        return [{'voodooId': self.card_ids[i], 'name': self.names[i]} for i in results]
+
+
+def get_cards_version(db_client: Database) -> Optional[str]:
+    metadata = db_client[VOODOO_MONGO_COLLECTION_METADATA].find_one({'name': VOODOO_MONGO_COLLECTION_CARDS})
+
+    return None if metadata is None else metadata['version']
+
+
+def build_card_index(db_client: Database) -> CardIndex:
+    logger.info('building card index')
+
+    version = get_cards_version(db_client)
+    card_index = CardIndex(db_client[VOODOO_MONGO_COLLECTION_CARDS].find({}, {'_id': False}), version)
+
+    logger.info(f'building card index completed, {len(card_index)} cards indexed')
+
+    return card_index
+
+
+async def refresh_card_index(app: web.Application):
+    db_client = app.settings['db_client']
+    io_loop = ioloop.IOLoop.current()
+
+    version = await io_loop.run_in_executor(None, get_cards_version, db_client)
+    if version == app.settings['card_index'].version:
+        return
+
+    app.settings['card_index'] = await io_loop.run_in_executor(None, build_card_index, db_client)
+
+
+async def refresh_card_index_periodically(app: web.Application):
+    # a single loop awaits each rebuild, so a slow rebuild can never overlap the next check
+    while True:
+        await asyncio.sleep(CARD_INDEX_REFRESH_INTERVAL)
+
+        try:
+            await refresh_card_index(app)
+        except Exception:
+            logger.exception('refreshing card index failed')
+
+
+def get_model(redis_client: Redis, model_cache: dict, version: str,
+              format_name: str) -> Optional[Tuple[np.ndarray, dict]]:
+    # versioned keys are never rewritten, so a model can be cached until the version changes
+    model = model_cache.get((version, format_name))
+    if model is not None:
+        return model
+
+    card_ids_pickle, filters_pickle = redis_client.mget([
+        get_format_key(version, format_name, REDIS_CARD_IDS_KEY),
+        get_format_key(version, format_name, REDIS_FILTERS_KEY)])
+    if card_ids_pickle is None or filters_pickle is None:
+        return None
+
+    card_ids = pickle.loads(card_ids_pickle)
+    filters = pickle.loads(filters_pickle)
+    if filters['bits'].shape[1] != (len(card_ids) + 7) // 8:
+        logger.error(f'filters for {format_name} in version {version} do not match its card ids')
+        return None
+
+    for key in [key for key in model_cache if key[0] != version]:
+        del model_cache[key]
+    model_cache[(version, format_name)] = (card_ids, filters)
+
+    return card_ids, filters
+
+
+def get_filter_mask(filters: dict, n_cards: int, legality: Optional[str], colors: List[str],
+                    types: List[str]) -> Tuple[np.ndarray, List[str]]:
+    bits = filters['bits']
+    rows = {name: i for i, name in enumerate(filters['names'])}
+    mask = np.full(bits.shape[1], 0xff, dtype=np.uint8)
+    invalid_filters = []
+
+    if legality is not None:
+        legality_filter = f'legal:{legality.lower()}'
+        if legality_filter in rows:
+            mask &= bits[rows[legality_filter]]
+        else:
+            invalid_filters.append(legality_filter)
+
+    if len(colors) > 0:
+        invalid_filters += [f'color:{color}' for color in colors if color not in COLORS]
+        excluded_rows = [rows[f'color:{color}'] for color in COLORS if color not in colors and f'color:{color}' in rows]
+        if len(excluded_rows) > 0:
+            mask &= ~np.bitwise_or.reduce(bits[excluded_rows], axis=0)
+
+    if len(types) > 0:
+        invalid_filters += [f'type:{card_type}' for card_type in types if f'type:{card_type}' not in rows]
+        type_rows = [rows[f'type:{card_type}'] for card_type in types if f'type:{card_type}' in rows]
+        if len(type_rows) > 0:
+            mask &= np.bitwise_or.reduce(bits[type_rows], axis=0)
+
+    return np.unpackbits(mask, count=n_cards).astype(bool), invalid_filters
+
+
 class CardHandler(web.RequestHandler):
     def get(self, card_id: str = None):
-        db_client = self.settings['db_client']
-        card = db_client.cards.find_one({'voodooId': card_id})
-        del card['_id']
+        card_index = self.settings['card_index']
+        card = card_index.get_card(card_id)
 
         if card is None:
             self.send_error(404)
             return
 
-        self.write(json_util.dumps(card))
+        self.set_header('Content-Type', 'application/json')
+        self.write(card)
+
+
+class CardSearchHandler(web.RequestHandler):
+    def get(self):
+        card_index = self.settings['card_index']
+
+        try:
+            query = self.get_argument('q')
+        except web.MissingArgumentError:
+            self.send_error(400, error={'error': 'no query provided'})
+            return
+
+        try:
+            limit = int(self.get_argument('limit', str(DEFAULT_NUMBER_OF_SEARCH_RESULTS)))
+        except ValueError:
+            self.send_error(400, error={'error': 'invalid limit provided'})
+            return
+
+        limit = max(1, min(limit, MAX_NUMBER_OF_SEARCH_RESULTS))
+
+        self.write({'cards': card_index.search(query, limit)})
+
+    def write_error(self, status_code: int, **kwargs):
+        self.write(kwargs.get('error', {'error': self._reason}))
 
 
 class RecommendationHandler(web.RequestHandler):
     def get(self):
-        db_client = self.settings['db_client']
+        card_index = self.settings['card_index']
         redis_client = self.settings['redis_client']
 
         try:
@@ -63,26 +281,66 @@ class RecommendationHandler(web.RequestHandler):
             self.send_error(400, error={'error': 'no card ids provided'})
             return
 
-        card_recommendations = []
+        card_id_list = [s for s in str.split(card_ids, ',') if s]
+        if len(card_id_list) == 0:
+            self.send_error(400, error={'error': 'no card ids provided'})
+            return
+
+        format_name = self.get_argument('format', DEFAULT_FORMAT).lower()
+        version = get_version(redis_client)
+        if version is None or not redis_client.sismember(get_formats_key(version), format_name):
+            self.send_error(400, error={'error': 'invalid format provided', 'format': format_name})
+            return
+
+        legality = self.get_argument('legality', None if format_name == DEFAULT_FORMAT else format_name)
+        colors = [s.upper() for s in str.split(self.get_argument('colors', ''), ',') if s]
+        types = [s.lower() for s in str.split(self.get_argument('types', ''), ',') if s]
+
+        model = get_model(redis_client, self.settings['model_cache'], version, format_name)
+        if model is None:
+            self.send_error(503, error={'error': 'recommendation model unavailable', 'format': format_name})
+            return
+
+        recommendation_ids, filters = model
+
+        card_correlations = []
         invalid_card_ids = []
-        for card_id in [s for s in str.split(card_ids, ',') if s]:
-            card_recommendations_pickle = redis_client.get(card_id)
-            if card_recommendations_pickle is None:
+        inconsistent_card_ids = []
+        card_keys = [get_format_key(version, format_name, card_id) for card_id in card_id_list]
+        for card_id, correlations_bytes in zip(card_id_list, redis_client.mget(card_keys)):
+            if correlations_bytes is None:
                 invalid_card_ids.append(card_id)
-            else:
-                card_recommendations_df = pickle.loads(card_recommendations_pickle)
-                card_recommendations_df = card_recommendations_df.iloc[1:, :]
+                continue
 
-                card_recommendations.append(card_recommendations_df)
+            card_correlations.append(np.frombuffer(correlations_bytes, dtype=np.float32))
+            if len(card_correlations[-1]) != len(recommendation_ids):
+                inconsistent_card_ids.append(card_id)
 
         if len(invalid_card_ids) > 0:
             error = {'error': 'invalid card ids provided', 'invalid_card_ids': invalid_card_ids}
             self.send_error(400, error=error)
             return
 
-        merged_recommendations = pd.concat([d.set_index('voodooId') for d in card_recommendations], axis=1)
-        recommendations = merged_recommendations.mean(axis=1).sort_values(ascending=False)
-        recommendations = recommendations.head(DEFAULT_NUMBER_OF_RECOMMENDATIONS)
+        if len(inconsistent_card_ids) > 0:
+            error = {'error': 'inconsistent recommendation model', 'inconsistent_card_ids': inconsistent_card_ids}
+            self.send_error(500, error=error)
+            return
+
+        mask, invalid_filters = get_filter_mask(filters, len(recommendation_ids), legality, colors, types)
+
+        if len(invalid_filters) > 0:
+            error = {'error': 'invalid filters provided', 'invalid_filters': invalid_filters}
+            self.send_error(400, error=error)
+            return
+
+        correlations = np.mean(card_correlations, axis=0)
+        mask &= ~np.isin(recommendation_ids, card_id_list) & ~np.isnan(correlations)
+
+        candidates = np.flatnonzero(mask)
+        if len(candidates) > DEFAULT_NUMBER_OF_RECOMMENDATIONS:
+            top = np.argpartition(-correlations[candidates], DEFAULT_NUMBER_OF_RECOMMENDATIONS)
+            candidates = candidates[top[:DEFAULT_NUMBER_OF_RECOMMENDATIONS]]
+        candidates = candidates[np.argsort(-correlations[candidates], kind='stable')]
 
         response = {
             'cards': []
@@ -90,14 +348,11 @@ class RecommendationHandler(web.RequestHandler):
 
         unknown_cards = []
 
-        for i in range(len(recommendations)):
-            card_id = recommendations.index[i]
-            card = db_client.cards.find_one({'voodooId': card_id})
-            if card is None:
+        for card_id in recommendation_ids[candidates]:
+            name = card_index.get_name(card_id)
+            if name is None:
                 unknown_cards.append(card_id)
                 name = 'UNKNOWN_CARD_NAME'
-            else:
-                name = card['name']
             response['cards'].append({'voodooId': card_id, 'name': name})
 
         if len(unknown_cards) > 0:
@@ -106,18 +361,21 @@ class RecommendationHandler(web.RequestHandler):
         self.write(response)
 
     def write_error(self, status_code: int, **kwargs):
-        self.write(kwargs['error'])
+        self.write(kwargs.get('error', {'error': self._reason}))
 
 
 def main():
     db_client = get_database('localhost', '27017', 'mongoadmin', 'mongoadmin')
     redis_client = get_redis_client('localhost', 6379, None)
+    card_index = build_card_index(db_client)
     app = web.Application([
+        (r'/cards/search', CardSearchHandler),
         (r'/cards/([0-9a-fA-F-]*)', CardHandler),
         (r'/recommendations', RecommendationHandler)
-    ], db_client=db_client, redis_client=redis_client)
+    ], db_client=db_client, redis_client=redis_client, card_index=card_index, model_cache={})
 
     app.listen(8000)
+    ioloop.IOLoop.current().spawn_callback(refresh_card_index_periodically, app)
     ioloop.IOLoop.current().start()
 
 